@@ -95,7 +95,11 @@ def recommend_stocks() :
     amt = int(request.args.get("amt", default=10000) )
     months = int(request.args.get("months", default=12) )
     n = int(request.args.get("nStocks", default=10) )
-    recommendedStocks = recommendStocks(amt,months,n,STOCK_DATA_COLLECTION_NAME)
+    maxWeight = float(request.args.get("maxWeight", default=0.2) )
+    # Also rejects nan, which fails every comparison
+    if not(0 < maxWeight <= 1) : 
+        return jsonify({"error" : "maxWeight must be greater than 0 and atmost 1!"}), 400
+    recommendedStocks = recommendStocks(amt,months,n,STOCK_DATA_COLLECTION_NAME,maxWeight)
     return jsonify(recommendedStocks)
 
 @app.route("/api/getStockData", methods = ["GET"])
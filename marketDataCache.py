@@ -0,0 +1,178 @@
+import os
+import tempfile
+from datetime import datetime
+
+import numpy
+import pandas
+import yfinance
+
+from marketSnapshot import dateToDay, dayToDate
+
+
+# Cache File Layout (one compressed .npz per ticker)
+#   dates    : int32 days since epoch of every cached bar, sorted
+#   columns  : names of the bar columns (Open, High, Low, Close, ...)
+#   col_<i>  : values of the i-th column, in its original dtype
+#   ranges   : int32 [start, end) day ranges already fetched from yfinance,
+#              so holidays and weekends inside them are not refetched
+
+# An empty response for a range with more weekdays than this is treated as a
+# failed fetch (yfinance returns empty frames on rate limits), not a holiday
+MAX_HOLIDAY_WEEKDAYS = 3
+
+
+def _cacheFilePath(cacheDir : str, ticker : str) -> str :
+    return os.path.join(cacheDir, ticker.replace(".", "_") + ".npz")
+
+def _emptyBars() -> pandas.DataFrame :
+    return pandas.DataFrame(index=pandas.DatetimeIndex([], name="Date"))
+
+def loadCachedBars(cacheDir : str, ticker : str) -> tuple :
+    """
+    Load the cached bars of a ticker.
+
+    Returns:
+    tuple: (bars DataFrame indexed by date, list of fetched [start, end) day ranges)
+
+    """
+
+    path = _cacheFilePath(cacheDir, ticker)
+    if not os.path.exists(path) :
+        return _emptyBars(), []
+
+    with numpy.load(path, allow_pickle=False) as npz :
+        index = pandas.DatetimeIndex(npz["dates"].astype("datetime64[D]").astype("datetime64[ns]"), name="Date")
+        columns = [str(col) for col in npz["columns"]]
+        bars = pandas.DataFrame({col : npz[f"col_{i}"] for i, col in enumerate(columns)}, index=index)
+        ranges = [(int(start), int(end)) for start, end in npz["ranges"]]
+
+    return bars, ranges
+
+def saveCachedBars(cacheDir : str, ticker : str, bars : pandas.DataFrame, ranges : list) :
+    os.makedirs(cacheDir, exist_ok=True)
+
+    arrays = {
+        "dates" : bars.index.values.astype("datetime64[D]").astype(numpy.int32),
+        "columns" : numpy.array(list(bars.columns), dtype=str),
+        "ranges" : numpy.array(ranges, dtype=numpy.int32).reshape(-1, 2),
+    }
+    for i, col in enumerate(bars.columns) :
+        arrays[f"col_{i}"] = bars[col].to_numpy()
+
+    # Writing to a temp file first so a crash never leaves a half written cache
+    fd, tmpPath = tempfile.mkstemp(prefix=".marketData-", dir=cacheDir)
+    try :
+        with os.fdopen(fd, "wb") as f :
+            numpy.savez_compressed(f, **arrays)
+        os.replace(tmpPath, _cacheFilePath(cacheDir, ticker))
+    except Exception :
+        if os.path.exists(tmpPath) :
+            os.remove(tmpPath)
+        raise
+
+def mergeRanges(ranges : list) -> list :
+    merged = []
+    for start, end in sorted(ranges) :
+        if merged and start <= merged[-1][1] :
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else :
+            merged.append((start, end))
+    return merged
+
+def missingRanges(ranges : list, startDay : int, endDay : int) -> list :
+    """
+    Get the parts of [startDay, endDay) not covered by the already fetched ranges.
+
+    """
+
+    missing = []
+    curr = startDay
+    for start, end in mergeRanges(ranges) :
+        if end <= curr :
+            continue
+        if start >= endDay :
+            break
+        if start > curr :
+            missing.append((curr, start))
+        curr = max(curr, end)
+
+    if curr < endDay :
+        missing.append((curr, endDay))
+
+    return missing
+
+def fetchTickerHistory(ticker : str, startDate, endDate, cacheDir : str, offline : bool = False) -> tuple :
+    """
+    Get the daily bars of a ticker between startDate (inclusive) and endDate (exclusive),
+    same as yfinance.Ticker.history, downloading only the ranges missing from the local cache.
+
+    Only the bars before the first range that is still missing (failed fetch,
+    or not cached in offline mode) are returned, so callers never skip over a gap.
+
+    Parameters:
+    ticker (str): The yfinance ticker symbol (eg. "ABB.NS").
+    startDate (str | date | datetime): First date to fetch.
+    endDate (str | date | datetime): Date to fetch till, not included.
+    cacheDir (str): Directory holding the cache files.
+    offline (bool, optional): Only replay cached data, never call yfinance. Defaults to False.
+
+    Returns:
+    tuple: (bars DataFrame indexed by date, True if the whole range is cached)
+
+    """
+
+    startDay = dateToDay(startDate)
+    endDay = dateToDay(endDate)
+
+    bars, ranges = loadCachedBars(cacheDir, ticker)
+    gaps = missingRanges(ranges, startDay, endDay)
+
+    if gaps and offline :
+        print(f"Offline Replay : {len(gaps)} uncached range(s) for {ticker}")
+
+    elif gaps :
+        # Todays bar is not final yet, so it is never marked as fetched
+        todayDay = dateToDay(datetime.now().date())
+        fetchedFrames = [bars]
+        emptyGaps = []
+
+        for gapStart, gapEnd in gaps :
+            print(f"Fetching Data form the YFinance for {ticker} : {dayToDate(gapStart)} to {dayToDate(gapEnd)}")
+            data:pandas.DataFrame = yfinance.Ticker(ticker).history(start=dayToDate(gapStart), end=dayToDate(gapEnd), interval="1d")
+            fetchedEnd = min(gapEnd, todayDay)
+
+            if not(data.empty) :
+                # Keeping the exchange local date of each bar
+                data.index = pandas.DatetimeIndex(pandas.to_datetime(data.index.strftime("%Y-%m-%d")), name="Date")
+                fetchedFrames.append(data)
+                if gapStart < fetchedEnd :
+                    ranges.append((gapStart, fetchedEnd))
+            elif gapStart < fetchedEnd :
+                emptyGaps.append((gapStart, fetchedEnd))
+
+        fetchedFrames = [frame for frame in fetchedFrames if not frame.empty]
+        if fetchedFrames :
+            bars = pandas.concat(fetchedFrames)
+        bars = bars[~bars.index.duplicated(keep="last")].sort_index()
+
+        # Empty ranges are only marked as fetched when they cannot hold a trading day,
+        # or are a short holiday with bars after them, otherwise they are retried next time
+        lastBarDay = dateToDay(bars.index[-1]) if len(bars) else -1
+        for gapStart, gapEnd in emptyGaps :
+            weekdays = int(numpy.busday_count(dayToDate(gapStart), dayToDate(gapEnd)))
+            if weekdays == 0 or (weekdays <= MAX_HOLIDAY_WEEKDAYS and lastBarDay >= gapEnd) :
+                ranges.append((gapStart, gapEnd))
+
+        ranges = mergeRanges(ranges)
+
+        saveCachedBars(cacheDir, ticker, bars, ranges)
+
+    # Stopping at the first range that is still missing
+    remaining = missingRanges(ranges, startDay, endDay)
+    if remaining :
+        endDay = remaining[0][0]
+
+    startTs = pandas.Timestamp(dayToDate(startDay))
+    endTs = pandas.Timestamp(dayToDate(endDay))
+
+    return bars[(bars.index >= startTs) & (bars.index < endTs)], not remaining
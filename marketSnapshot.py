@@ -0,0 +1,240 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from datetime import datetime, date, timedelta
+
+import numpy
+
+
+# Snapshot File Layout
+#   [8 bytes]  magic
+#   [8 bytes]  header length (little endian uint64)
+#   [n bytes]  header JSON (ticker -> offset index + predictions)
+#   [padding]  up to a 64 byte boundary
+#   [data]     int32 dates (days since epoch) for all tickers, back to back
+#   [padding]  up to an 8 byte boundary
+#   [data]     float64 close prices for all tickers, back to back
+SNAPSHOT_MAGIC = b"MMSNAP01"
+SNAPSHOT_PREFIX = struct.Struct("<8sQ")
+SNAPSHOT_DATA_ALIGN = 64
+
+# Per process cache of the currently mapped snapshot
+_snapshotCache = {}
+_snapshotCacheLock = threading.Lock()
+
+
+def _alignUp(n : int, align : int) -> int :
+    return (n + align - 1) // align * align
+
+# Date Functions (days since 1970-01-01, shared with marketDataCache)
+def dayToDate(day : int) -> date :
+    return numpy.datetime64(int(day), "D").astype(date)
+
+def dateToDay(d) -> int :
+    if (type(d) == str) :
+        d = datetime.strptime(d, "%Y-%m-%d")
+    # Also covers pandas.Timestamp, which subclasses datetime
+    if (isinstance(d, datetime)) :
+        d = d.date()
+    return int(numpy.datetime64(d, "D").astype(numpy.int64))
+
+def buildMarketSnapshot(stockDataDict : dict, snapshotPath : str) -> dict :
+    """
+    Pack the history and predictions of every ticker into a single snapshot file.
+
+    The file is written to a temporary path and then renamed over the old
+    snapshot, so workers reading the previous version are never disturbed.
+
+    Parameters:
+    stockDataDict (dict): Mapping of document name (eg. "ABB_NS") to its stock data dict.
+    snapshotPath (str): The file path of the snapshot to (re)write.
+
+    Returns:
+    dict: The header that was written to the snapshot.
+
+    """
+
+    tickerIndex = {}
+    dateArrays = []
+    closeArrays = []
+    offset = 0
+
+    for docName, stockData in stockDataDict.items() :
+        histData = stockData.get("historicalData", [])
+        dates = numpy.array([obj["Date"] for obj in histData], dtype="datetime64[D]").astype(numpy.int32)
+        closes = numpy.array([obj["Close"] for obj in histData], dtype=numpy.float64)
+
+        # Keeping the history sorted by date so lookups can binary search
+        order = numpy.argsort(dates, kind="stable")
+        dateArrays.append(dates[order])
+        closeArrays.append(closes[order])
+
+        tickerIndex[docName] = {
+            "offset" : offset,
+            "length" : len(dates),
+            "ticker" : stockData.get("ticker", docName),
+            "stockName" : stockData.get("stockName"),
+            "iconURL" : stockData.get("iconURL"),
+            "predictions" : stockData.get("predictions", {}),
+            "lastDataUpdateDate" : stockData.get("lastDataUpdateDate"),
+            "lastPredictionsUpdateDate" : stockData.get("lastPredictionsUpdateDate"),
+        }
+        offset += len(dates)
+
+    header = {
+        "createdAt" : datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "nRows" : offset,
+        "tickers" : tickerIndex,
+    }
+    headerBytes = json.dumps(header).encode("utf-8")
+
+    allDates = numpy.concatenate(dateArrays) if dateArrays else numpy.empty(0, dtype=numpy.int32)
+    allCloses = numpy.concatenate(closeArrays) if closeArrays else numpy.empty(0, dtype=numpy.float64)
+
+    dataOffset = _alignUp(SNAPSHOT_PREFIX.size + len(headerBytes), SNAPSHOT_DATA_ALIGN)
+    closeOffset = _alignUp(dataOffset + allDates.nbytes, 8)
+
+    snapshotDir = os.path.dirname(os.path.abspath(snapshotPath))
+    os.makedirs(snapshotDir, exist_ok=True)
+
+    fd, tmpPath = tempfile.mkstemp(prefix=".marketSnapshot-", dir=snapshotDir)
+    try :
+        with os.fdopen(fd, "wb") as f :
+            f.write(SNAPSHOT_PREFIX.pack(SNAPSHOT_MAGIC, len(headerBytes)))
+            f.write(headerBytes)
+            f.write(b"\0" * (dataOffset - f.tell()))
+            f.write(allDates.astype("<i4").tobytes())
+            f.write(b"\0" * (closeOffset - f.tell()))
+            f.write(allCloses.astype("<f8").tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Atomically switching to the new version
+        os.replace(tmpPath, snapshotPath)
+    except Exception :
+        if os.path.exists(tmpPath) :
+            os.remove(tmpPath)
+        raise
+
+    return header
+
+def loadMarketSnapshot(snapshotPath : str) -> dict :
+    """
+    Memory map a snapshot file read-only.
+
+    The date and price arrays are views over the mapping, so every worker
+    process shares the same physical pages through the OS page cache.
+
+    Parameters:
+    snapshotPath (str): The file path of the snapshot.
+
+    Returns:
+    dict: The snapshot header with the "dates" and "closes" arrays added.
+
+    Raises:
+    ValueError: If the file is not a market snapshot.
+
+    """
+
+    with open(snapshotPath, "rb") as f :
+        stat = os.fstat(f.fileno())
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, headerLen = SNAPSHOT_PREFIX.unpack_from(mapping, 0)
+    if magic != SNAPSHOT_MAGIC :
+        raise ValueError(f"{snapshotPath} : Not a Market Snapshot!")
+
+    header = json.loads(mapping[SNAPSHOT_PREFIX.size : SNAPSHOT_PREFIX.size + headerLen].decode("utf-8"))
+    nRows = header["nRows"]
+    dataOffset = _alignUp(SNAPSHOT_PREFIX.size + headerLen, SNAPSHOT_DATA_ALIGN)
+    closeOffset = _alignUp(dataOffset + nRows * 4, 8)
+
+    header["dates"] = numpy.frombuffer(mapping, dtype="<i4", count=nRows, offset=dataOffset)
+    header["closes"] = numpy.frombuffer(mapping, dtype="<f8", count=nRows, offset=closeOffset)
+    header["fileId"] = (stat.st_ino, stat.st_mtime_ns)
+
+    return header
+
+def getMarketSnapshot(snapshotPath : str) -> dict :
+    """
+    Get the latest snapshot, remapping it only when the file has been replaced.
+
+    Returns None if no snapshot has been built yet.
+
+    """
+
+    try :
+        stat = os.stat(snapshotPath)
+    except FileNotFoundError :
+        return None
+
+    fileId = (stat.st_ino, stat.st_mtime_ns)
+
+    with _snapshotCacheLock :
+        snapshot = _snapshotCache.get(snapshotPath)
+        if snapshot is None or snapshot["fileId"] != fileId :
+            try :
+                snapshot = loadMarketSnapshot(snapshotPath)
+            except (FileNotFoundError, ValueError) as e :
+                print("Couldnt Load Market Snapshot!")
+                print(e)
+                return snapshot
+            _snapshotCache[snapshotPath] = snapshot
+
+    return snapshot
+
+def getSnapshotHistory(snapshot : dict, docName : str) -> tuple :
+    """
+    Get the (dates, closes) arrays of a ticker as read-only views into the snapshot.
+
+    Dates are numpy int32 days since 1970-01-01.
+
+    """
+
+    entry = snapshot["tickers"][docName]
+    start = entry["offset"]
+    end = start + entry["length"]
+
+    return snapshot["dates"][start:end], snapshot["closes"][start:end]
+
+def getSnapshotCurrPrice(snapshot : dict, docName : str) -> float :
+    _, closes = getSnapshotHistory(snapshot, docName)
+    return float(closes[-1])
+
+def calculateSnapshotGrowth(snapshot : dict, docName : str, fromDate, toDate = None) -> float :
+    """
+    Same as calculateStockGrowth, but binary searches the snapshot arrays
+    instead of scanning the historical data list.
+
+    """
+
+    dates, closes = getSnapshotHistory(snapshot, docName)
+    fromDay = dateToDay(fromDate)
+    toDay = dates[-1] if toDate is None else dateToDay(toDate)
+
+    startIdx = numpy.searchsorted(dates, fromDay, side="left")
+    endIdx = numpy.searchsorted(dates, toDay, side="right") - 1
+
+    # No bars in the window (eg. a suspended stock)
+    if startIdx >= len(dates) or endIdx < startIdx :
+        return 0.0
+
+    # Calculating the percent increase
+    percentGrowth = ((closes[endIdx] - closes[startIdx]) / closes[startIdx]) * 100
+
+    return round(float(percentGrowth), 2)
+
+def calculateSnapshotRecentGrowth(snapshot : dict, docName : str, days : int = 7) -> float :
+    """
+    Percent growth over the last `days` days of a ticker's history,
+    matching alterDataForCurrTopStocks.
+
+    """
+
+    dates, _ = getSnapshotHistory(snapshot, docName)
+    toDate = dayToDate(dates[-1])
+
+    return calculateSnapshotGrowth(snapshot, docName, toDate - timedelta(days=days), toDate)
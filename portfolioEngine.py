@@ -0,0 +1,418 @@
+import os
+import tempfile
+import threading
+
+import numpy
+
+from marketSnapshot import getSnapshotHistory, getSnapshotCurrPrice
+
+
+TRADING_DAYS_PER_YEAR = 252
+RETURN_WINDOW_DAYS = 252
+# Stocks with fewer real daily returns in the window are left out of allocations
+MIN_RETURN_OBSERVATIONS = 60
+
+# Per process cache of the currently loaded return model
+_returnModelCache = {}
+_returnModelCacheLock = threading.Lock()
+
+
+# Return Model Functions
+def _gridReturns(snapshot : dict, tickers : list, gridDays : numpy.ndarray) -> tuple :
+    """
+    Daily log returns between consecutive grid days, along with a mask of which
+    of them are real observations.
+
+    A return is only valid if the ticker has a bar on that grid day and some
+    earlier price; rows before a ticker's first bar or on days it did not trade
+    (suspended, lagging) are 0 and masked out, not counted as flat days.
+
+    """
+
+    # Last close on or before each grid day, NaN before a ticker's first bar
+    prices = numpy.full((len(gridDays), len(tickers)), numpy.nan)
+    hasBar = numpy.zeros((len(gridDays), len(tickers)), dtype=bool)
+    for j, ticker in enumerate(tickers) :
+        dates, closes = getSnapshotHistory(snapshot, ticker)
+        idx = numpy.searchsorted(dates, gridDays, side="right") - 1
+        found = idx >= 0
+        prices[found, j] = closes[idx[found]]
+        hasBar[found, j] = dates[idx[found]] == gridDays[found]
+
+    with numpy.errstate(divide="ignore", invalid="ignore") :
+        returns = numpy.diff(numpy.log(prices), axis=0)
+
+    valid = hasBar[1:] & numpy.isfinite(returns)
+    returns = numpy.where(valid, returns, 0.0)
+
+    return returns, valid
+
+def _modelSums(returns : numpy.ndarray, valid : numpy.ndarray) -> tuple :
+    # Pairwise sums over the days both tickers have real returns,
+    # pairSums[i, j] is the sum of i's returns on days j is also valid
+    validF = valid.astype(numpy.float64)
+    return returns.T @ validF, validF.T @ validF, returns.T @ returns
+
+def _tickerLastDays(snapshot : dict, tickers : list) -> numpy.ndarray :
+    return numpy.array([getSnapshotHistory(snapshot, ticker)[0][-1] for ticker in tickers], dtype=numpy.int64)
+
+def buildReturnModel(snapshot : dict, window : int = RETURN_WINDOW_DAYS) -> dict :
+    """
+    Build the daily log return matrix of the whole universe on a common date grid,
+    along with the running sums needed for its rolling covariance.
+
+    Parameters:
+    snapshot (dict): The market snapshot to read prices from.
+    window (int, optional): Number of return rows to keep. Defaults to 252.
+
+    Returns:
+    dict: The return model.
+
+    """
+
+    tickers = sorted(ticker for ticker, entry in snapshot["tickers"].items() if entry["length"] > 0)
+    allDays = [getSnapshotHistory(snapshot, ticker)[0] for ticker in tickers]
+    gridDays = numpy.unique(numpy.concatenate(allDays))[-(window + 1):] if allDays else numpy.empty(0, dtype=numpy.int32)
+
+    returns, valid = _gridReturns(snapshot, tickers, gridDays)
+    pairSums, pairCounts, crossProducts = _modelSums(returns, valid)
+
+    return {
+        "tickers" : numpy.array(tickers, dtype=str),
+        "window" : window,
+        "lastDay" : int(gridDays[-1]) if len(gridDays) else -1,
+        "days" : gridDays[1:].astype(numpy.int64),
+        "tickerLastDays" : _tickerLastDays(snapshot, tickers),
+        "returns" : returns,
+        "valid" : valid,
+        "pairSums" : pairSums,
+        "pairCounts" : pairCounts,
+        "crossProducts" : crossProducts,
+    }
+
+def advanceReturnModel(snapshot : dict, model : dict) -> dict :
+    """
+    Append the return rows for days newer than the model's last day and drop
+    the rows that fall out of the window, updating the sums in place of a
+    full recomputation.
+
+    Rows after the last bar a ticker had when the model was built were computed
+    from forward filled prices, so if that ticker has since got bars for those
+    days, the rows from there on are recomputed too.
+
+    Rebuilds from scratch if the ticker universe has changed.
+
+    """
+
+    tickers = [str(ticker) for ticker in model["tickers"]]
+    currTickers = sorted(ticker for ticker, entry in snapshot["tickers"].items() if entry["length"] > 0)
+    if tickers != currTickers or model["lastDay"] < 0 or "valid" not in model :
+        return buildReturnModel(snapshot, model["window"])
+
+    # Earliest day a lagging ticker has received late bars after
+    recomputeAfter = model["lastDay"]
+    for j, ticker in enumerate(tickers) :
+        prevLastDay = model["tickerLastDays"][j]
+        if prevLastDay >= model["lastDay"] :
+            continue
+        dates, _ = getSnapshotHistory(snapshot, ticker)
+        if numpy.any((dates > prevLastDay) & (dates <= model["lastDay"])) :
+            recomputeAfter = min(recomputeAfter, int(prevLastDay))
+
+    keep = model["days"] <= recomputeAfter
+    if not keep.any() :
+        return buildReturnModel(snapshot, model["window"])
+
+    allDays = numpy.concatenate([getSnapshotHistory(snapshot, ticker)[0] for ticker in tickers])
+    newDays = numpy.unique(allDays[allDays > recomputeAfter])
+    if len(newDays) == 0 :
+        return model
+
+    anchorDay = model["days"][keep][-1]
+    gridDays = numpy.concatenate([[anchorDay], newDays[newDays > anchorDay]])
+    newReturns, newValid = _gridReturns(snapshot, tickers, gridDays)
+
+    # Taking out the rows being recomputed
+    staleSums = _modelSums(model["returns"][~keep], model["valid"][~keep])
+    addedSums = _modelSums(newReturns, newValid)
+    pairSums, pairCounts, crossProducts = [
+        curr - stale + added
+        for curr, stale, added in zip((model["pairSums"], model["pairCounts"], model["crossProducts"]), staleSums, addedSums)
+    ]
+    returns = numpy.concatenate([model["returns"][keep], newReturns])
+    valid = numpy.concatenate([model["valid"][keep], newValid])
+    days = numpy.concatenate([model["days"][keep], gridDays[1:]])
+
+    # Dropping the rows that fell out of the rolling window
+    nDrop = max(0, len(returns) - model["window"])
+    if nDrop > 0 :
+        oldSums = _modelSums(returns[:nDrop], valid[:nDrop])
+        pairSums, pairCounts, crossProducts = [curr - old for curr, old in zip((pairSums, pairCounts, crossProducts), oldSums)]
+        returns = returns[nDrop:]
+        valid = valid[nDrop:]
+        days = days[nDrop:]
+
+    return {
+        "tickers" : model["tickers"],
+        "window" : model["window"],
+        "lastDay" : int(days[-1]),
+        "days" : days,
+        "tickerLastDays" : _tickerLastDays(snapshot, tickers),
+        "returns" : returns,
+        "valid" : valid,
+        "pairSums" : pairSums,
+        "pairCounts" : pairCounts,
+        "crossProducts" : crossProducts,
+    }
+
+def returnCovariance(model : dict) -> numpy.ndarray :
+    """
+    Pairwise sample covariance of the daily log returns in the model's window,
+    each entry using only the days both stocks have real returns.
+
+    Pairs with fewer than 2 common days get 0, and the result is clipped to the
+    nearest positive semi-definite matrix so the allocation stays convex.
+
+    """
+
+    pairCounts = model["pairCounts"]
+    pairSums = model["pairSums"]
+    n = len(model["tickers"])
+    if n == 0 :
+        return numpy.zeros((0, 0))
+
+    with numpy.errstate(divide="ignore", invalid="ignore") :
+        covariance = (model["crossProducts"] - pairSums * pairSums.T / pairCounts) / (pairCounts - 1)
+    covariance = numpy.where(pairCounts >= 2, covariance, 0.0)
+    covariance = (covariance + covariance.T) / 2
+
+    eigVals, eigVecs = numpy.linalg.eigh(covariance)
+    return (eigVecs * numpy.clip(eigVals, 0, None)) @ eigVecs.T
+
+def saveReturnModel(model : dict, modelPath : str) :
+    modelDir = os.path.dirname(os.path.abspath(modelPath))
+    os.makedirs(modelDir, exist_ok=True)
+
+    # Writing to a temp file first so workers never load a half written model
+    fd, tmpPath = tempfile.mkstemp(prefix=".returnModel-", dir=modelDir)
+    try :
+        with os.fdopen(fd, "wb") as f :
+            numpy.savez(f, **model)
+        os.replace(tmpPath, modelPath)
+    except Exception :
+        if os.path.exists(tmpPath) :
+            os.remove(tmpPath)
+        raise
+
+def loadReturnModel(modelPath : str) -> dict :
+    with numpy.load(modelPath, allow_pickle=False) as npz :
+        model = {key : npz[key] for key in npz.files}
+
+    model["window"] = int(model["window"])
+    model["lastDay"] = int(model["lastDay"])
+
+    return model
+
+def updateReturnModel(snapshot : dict, modelPath : str, window : int = RETURN_WINDOW_DAYS) -> dict :
+    """
+    Incrementally bring the saved return model up to date with the snapshot.
+
+    """
+
+    model = None
+    if os.path.exists(modelPath) :
+        try :
+            model = loadReturnModel(modelPath)
+        except Exception as e :
+            print("Couldnt Load Return Model, Rebuilding!")
+            print(e)
+
+    if model is None or model["window"] != window :
+        model = buildReturnModel(snapshot, window)
+    else :
+        model = advanceReturnModel(snapshot, model)
+
+    saveReturnModel(model, modelPath)
+
+    return model
+
+def getReturnModel(modelPath : str) -> dict :
+    """
+    Get the latest return model, reloading it only when the file has been replaced.
+
+    Returns None if no model has been built yet.
+
+    """
+
+    try :
+        stat = os.stat(modelPath)
+    except FileNotFoundError :
+        return None
+
+    fileId = (stat.st_ino, stat.st_mtime_ns)
+
+    with _returnModelCacheLock :
+        cached = _returnModelCache.get(modelPath)
+        if cached is None or cached["fileId"] != fileId :
+            try :
+                model = loadReturnModel(modelPath)
+            except Exception as e :
+                print("Couldnt Load Return Model!")
+                print(e)
+                return cached["model"] if cached else None
+            cached = {"fileId" : fileId, "model" : model, "covariance" : returnCovariance(model)}
+            _returnModelCache[modelPath] = cached
+
+    model = dict(cached["model"])
+    model["covariance"] = cached["covariance"]
+
+    return model
+
+
+# Allocation Functions
+def _projectCappedSimplex(v : numpy.ndarray, cap : float, budget : float) -> numpy.ndarray :
+    # Euclidean projection onto { 0 <= w <= cap, sum(w) = budget } by bisecting the shift
+    lo = v.min() - cap
+    hi = v.max()
+    for _ in range(60) :
+        tau = (lo + hi) / 2
+        if numpy.clip(v - tau, 0, cap).sum() > budget :
+            lo = tau
+        else :
+            hi = tau
+    return numpy.clip(v - hi, 0, cap)
+
+def solvePortfolioWeights(expReturns : numpy.ndarray, covariance : numpy.ndarray, maxWeight : float, riskAversion : float = 1.0, nIters : int = 500) -> numpy.ndarray :
+    """
+    Long only mean-variance weights with a max weight per stock,
+    maximizing expReturns.w - (riskAversion/2) * w.Cov.w by projected gradient ascent.
+
+    """
+
+    n = len(expReturns)
+    budget = min(1.0, maxWeight * n)
+
+    lipschitz = riskAversion * max(float(numpy.linalg.eigvalsh(covariance)[-1]), 0.0)
+    step = 1.0 / max(lipschitz, 1e-6)
+
+    weights = _projectCappedSimplex(numpy.full(n, budget / n), maxWeight, budget)
+    for _ in range(nIters) :
+        grad = expReturns - riskAversion * (covariance @ weights)
+        newWeights = _projectCappedSimplex(weights + step * grad, maxWeight, budget)
+        if numpy.abs(newWeights - weights).max() < 1e-9 :
+            weights = newWeights
+            break
+        weights = newWeights
+
+    return weights
+
+def wholeShareQuantities(weights : numpy.ndarray, prices : numpy.ndarray, investmentAmt : float, maxWeight : float) -> numpy.ndarray :
+    """
+    Round the target weights down to whole shares, then spend the leftover
+    cash one share at a time on the stocks furthest below their target.
+
+    """
+
+    target = weights * investmentAmt
+    quantities = numpy.floor(target / prices)
+    cash = investmentAmt - quantities @ prices
+    capAmt = maxWeight * investmentAmt
+
+    for _ in range(len(prices)) :
+        shortfall = target - quantities * prices
+        canBuy = (shortfall > 0) & (prices <= cash) & ((quantities + 1) * prices <= capAmt)
+        if not canBuy.any() :
+            break
+        i = numpy.argmax(numpy.where(canBuy, shortfall, -numpy.inf))
+        quantities[i] += 1
+        cash -= prices[i]
+
+    return quantities.astype(int)
+
+def allocatePortfolio(snapshot : dict, model : dict, investmentAmt : float, predictionKey : str, months : int, nStocks : int = 10, maxWeight : float = 0.2, riskAversion : float = 1.0, allowedTickers = None) -> list :
+    """
+    Pick at most nStocks stocks and whole-share quantities for the investment amount.
+
+    Expected returns come from the snapshot predictions for predictionKey and
+    risk from the model's rolling covariance scaled to the horizon.
+
+    Parameters:
+    snapshot (dict): The market snapshot.
+    model (dict): The return model from getReturnModel.
+    investmentAmt (float): Budget to allocate.
+    predictionKey (str): Prediction horizon key (eg. "1year").
+    months (int): Investment horizon in months.
+    nStocks (int, optional): Max number of stocks to pick. Defaults to 10.
+    maxWeight (float, optional): Max fraction of the budget in one stock. Defaults to 0.2.
+    riskAversion (float, optional): Weight of the variance penalty. Defaults to 1.0.
+    allowedTickers (set, optional): Only pick from these tickers (eg. the current tickersList). Defaults to all.
+
+    Returns:
+    list: Dicts of ticker, quantity, currPrice, amount and weight, largest amount first.
+
+    Raises:
+    ValueError: If maxWeight is not in (0, 1].
+
+    """
+
+    if not(0 < maxWeight <= 1) :
+        raise ValueError(f"maxWeight must be in (0, 1], got {maxWeight}")
+
+    modelTickers = [str(ticker) for ticker in model["tickers"]]
+    observations = numpy.diag(model["pairCounts"])
+    cols, tickers, prices, expReturns = [], [], [], []
+
+    for j, ticker in enumerate(modelTickers) :
+        if allowedTickers is not None and ticker not in allowedTickers :
+            continue
+
+        entry = snapshot["tickers"].get(ticker)
+        if entry is None or entry["length"] == 0 or predictionKey not in entry["predictions"] :
+            continue
+
+        # Too short a history to estimate its risk
+        if observations[j] < min(MIN_RETURN_OBSERVATIONS, model["window"]) :
+            continue
+
+        currPrice = getSnapshotCurrPrice(snapshot, ticker)
+        # Only stocks where atleast one share fits under the max weight
+        if not(0 < currPrice <= investmentAmt * maxWeight) :
+            continue
+
+        cols.append(j)
+        tickers.append(ticker)
+        prices.append(currPrice)
+        expReturns.append(entry["predictions"][predictionKey]["percentIncrease"] / 100)
+
+    if not cols :
+        return []
+
+    cols = numpy.array(cols)
+    prices = numpy.array(prices)
+    expReturns = numpy.array(expReturns)
+    covariance = model["covariance"][numpy.ix_(cols, cols)] * TRADING_DAYS_PER_YEAR * months / 12
+
+    weights = solvePortfolioWeights(expReturns, covariance, maxWeight, riskAversion)
+
+    # Keeping only the nStocks largest picks and resolving among them
+    picked = numpy.argsort(-weights, kind="stable")[:nStocks]
+    picked = picked[weights[picked] > 1e-6]
+    if len(picked) == 0 :
+        return []
+
+    weights = solvePortfolioWeights(expReturns[picked], covariance[numpy.ix_(picked, picked)], maxWeight, riskAversion)
+    quantities = wholeShareQuantities(weights, prices[picked], investmentAmt, maxWeight)
+
+    allocation = [
+        {
+            "ticker" : tickers[i],
+            "quantity" : int(quantity),
+            "currPrice" : float(prices[i]),
+            "amount" : round(float(quantity * prices[i]), 2),
+            "weight" : round(float(quantity * prices[i] / investmentAmt), 4),
+        }
+        for i, quantity in zip(picked, quantities) if quantity > 0
+    ]
+    allocation.sort(key = lambda obj : obj["amount"], reverse = True)
+
+    return allocation
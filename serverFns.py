@@ -1,6 +1,5 @@
 import pandas
 from datetime import datetime, date, timedelta
-import yfinance
 import json
 import time
 from prophet import Prophet
@@ -10,6 +9,10 @@ import threading
 
 from firebase_admin import firestore, credentials, initialize_app
 
+from marketSnapshot import buildMarketSnapshot, getMarketSnapshot, calculateSnapshotGrowth, calculateSnapshotRecentGrowth
+from marketDataCache import fetchTickerHistory
+from portfolioEngine import updateReturnModel, getReturnModel, allocatePortfolio
+
 
 # Initialize Firestore with your project credentials
 # Loading SDK from env
@@ -19,6 +22,14 @@ initialize_app(cred)
 
 DATA_UPDATE_LOG_FILE_PATH = "./logs/dataUpdateLog.txt"
 PREDICTION_UPDATE_LOG_FILE_PATH = "./logs/predictionUpdateLog.txt"
+MARKET_SNAPSHOT_FILE_PATH = "./AppReqData/marketSnapshot.bin"
+RETURN_MODEL_FILE_PATH = "./AppReqData/returnModel.npz"
+MARKET_DATA_CACHE_DIR = "./marketDataCache"
+# Set marketDataOffline=1 to replay only cached market data without calling YFinance
+MARKET_DATA_OFFLINE = os.getenv("marketDataOffline") == "1"
+
+# Serializes snapshot rebuilds between the data and prediction updater threads
+marketSnapshotLock = threading.Lock()
 
 # Common Functions
 getStockCurrPrice = lambda stockJson : stockJson["historicalData"][-1]["Close"]
@@ -53,10 +64,8 @@ def updateStockDataDict(jsonDataDict: dict, new_date: date = datetime.now().date
     
     # If the last update date is not today, then update the data
     if lastUpdateDate.date() != new_date :
-        print("Fetching Data form the YFinance...")
-        # Getting the data from the API
-        yfTicker = yfinance.Ticker(ticker)
-        data:pandas.DataFrame = yfTicker.history(start=startDate, end=new_date, interval="1d")
+        # Getting the data from the local cache, fetching only missing ranges from the API
+        data, fullyCached = fetchTickerHistory(ticker, startDate, new_date, MARKET_DATA_CACHE_DIR, MARKET_DATA_OFFLINE)
         
         # Only make Changes if the data is not empty
         if not(data.empty) :
@@ -68,11 +77,16 @@ def updateStockDataDict(jsonDataDict: dict, new_date: date = datetime.now().date
                 dataRecordList[i]["Date"] = date_vals[i].strftime("%Y-%m-%d")
             
             # Updating the last update date
-            stockData["lastDataUpdateDate"] = new_date.strftime("%Y-%m-%d")
+            # Only till the last bar if some range is still missing (failed fetch or offline replay),
+            # so the next run picks up from there instead of skipping the gap
+            updatedTillDate = new_date
+            if not fullyCached : 
+                updatedTillDate = date_vals[-1].date()
+            stockData["lastDataUpdateDate"] = updatedTillDate.strftime("%Y-%m-%d")
             # Joining with the existing Historical Data Dict
             stockData["historicalData"].extend(dataRecordList)
             
-            print(f"Data Updated for {ticker} till {new_date}!")
+            print(f"Data Updated for {ticker} till {updatedTillDate}!")
             
         else : 
             print(f"No updates for {ticker}")
@@ -359,6 +373,57 @@ def clearLog(logFileName : str) :
     with open(logFileName, "w") as f : 
         f.write("")
         f.close()
+
+# Snapshot Functions
+def updateMarketSnapshot(stockDataCollection, tickersList : list, logFileName : str) : 
+    """
+    Rebuild the shared market snapshot that the server workers memory map,
+    and bring the return model used by recommendStocks up to date with it.
+
+    The documents are re-read under the lock, so an updater that read its
+    documents hours earlier never replaces a newer snapshot with stale data.
+
+    """
+    with marketSnapshotLock : 
+        allStockData = {}
+        for ticker in tickersList : 
+            docData = stockDataCollection.document(ticker).get().to_dict()
+            if docData is not None : 
+                allStockData[ticker] = docData
+        
+        try : 
+            buildMarketSnapshot(allStockData, MARKET_SNAPSHOT_FILE_PATH)
+            logData("Market Snapshot Updated!", logFileName)
+        except Exception as e : 
+            logData("Couldnt Update Market Snapshot!", logFileName)
+            logData(str(e), logFileName)
+            return
+        
+        try : 
+            updateReturnModel(getMarketSnapshot(MARKET_SNAPSHOT_FILE_PATH), RETURN_MODEL_FILE_PATH)
+            logData("Return Model Updated!", logFileName)
+        except Exception as e : 
+            logData("Couldnt Update Return Model!", logFileName)
+            logData(str(e), logFileName)
+
+def getSnapshotRankedDocs(stockDataCollection, rankedTickers : list, n : int, alterFn = None) -> list : 
+    """
+    Read the documents of the best ranked tickers till n are found,
+    skipping tickers whose document no longer exists.
+
+    """
+    stockDataList = []
+    for ticker in rankedTickers : 
+        if len(stockDataList) >= n : 
+            break
+        
+        docData = stockDataCollection.document(ticker).get().to_dict()
+        if docData is None : 
+            continue
+        
+        stockDataList.append(alterFn(docData) if alterFn else docData)
+    
+    return stockDataList
         
 
 # Updater Functions
@@ -392,6 +457,7 @@ def updateAllFirebaseStockData(stockDataCollectionName:str,tillDate:date = datet
         logData(f"Data Updated for {ticker}!", DATA_UPDATE_LOG_FILE_PATH)
         
     logData("Data Updated Successfully!", DATA_UPDATE_LOG_FILE_PATH)    
+    updateMarketSnapshot(stockDataCollection, tickersList, DATA_UPDATE_LOG_FILE_PATH)
     
 def updateAllFirebaseStockPredictions (collectionName : str) : 
     clearLog(PREDICTION_UPDATE_LOG_FILE_PATH)
@@ -430,6 +496,9 @@ def updateAllFirebaseStockPredictions (collectionName : str) :
         except Exception as e : 
             logData(f"Error Updating Prediction for {ticker}!", PREDICTION_UPDATE_LOG_FILE_PATH)
             logData(e, PREDICTION_UPDATE_LOG_FILE_PATH)
+    
+    # Snapshot covers every ticker in the list, even if its prediction update failed
+    updateMarketSnapshot(stockDataCollection, tickersList, PREDICTION_UPDATE_LOG_FILE_PATH)
 
 def getTopStocks(collectionName : str, days : int = 7, n : int = 10) : 
     # Getting the Firestore Database
@@ -444,6 +513,19 @@ def getTopStocks(collectionName : str, days : int = 7, n : int = 10) :
     # Getting the List of Tickers
     tickersList = stockDataCollection.document("tickersList").get().to_dict()["tickers"]
     
+    # Ranking from the shared snapshot when available
+    # so only the top n documents are read from Firestore
+    snapshot = getMarketSnapshot(MARKET_SNAPSHOT_FILE_PATH)
+    if snapshot is not None : 
+        growthList = [
+            (ticker, calculateSnapshotRecentGrowth(snapshot, ticker, days))
+            for ticker in tickersList
+            if ticker in snapshot["tickers"] and snapshot["tickers"][ticker]["length"] > 0
+        ]
+        growthList.sort(key = lambda x : x[1], reverse = True)
+        
+        return getSnapshotRankedDocs(stockDataCollection, [ticker for ticker, _ in growthList], n, lambda docData : alterDataForCurrTopStocks(docData, days))
+    
     stockDataList = []
     
     for ticker in tickersList :
@@ -471,24 +553,36 @@ def getFutureTopStocks(stockDataCollectionName:str, months : int = 12,topN:int =
         print(f"{stockDataCollectionName} : No Collection Found!")
         return []
     
+    # Sorting the Stock Data List Based of Predeicted Values
+    keyVal = ""
+    if months < 12 : 
+        keyVal = f"{months}months"
+    elif months > 12 : 
+        keyVal = f"{months//12}years"
+    else : 
+        keyVal = "1year"
+    
     # Getting the List of Tickers
     tickersList = stockDataCollection.document("tickersList").get().to_dict()["tickers"]
+    
+    # Ranking from the shared snapshot when available
+    # so only the top n documents are read from Firestore
+    snapshot = getMarketSnapshot(MARKET_SNAPSHOT_FILE_PATH)
+    if snapshot is not None : 
+        rankedTickers = [
+            ticker for ticker in tickersList
+            if ticker in snapshot["tickers"] and keyVal in snapshot["tickers"][ticker]["predictions"]
+        ]
+        rankedTickers.sort(key = lambda ticker : snapshot["tickers"][ticker]["predictions"][keyVal]["percentIncrease"], reverse = True)
         
+        return getSnapshotRankedDocs(stockDataCollection, rankedTickers, topN)
+    
     stockDataList = []
     
     for ticker in tickersList :
         # Getting the Document Data
         docData = stockDataCollection.document(ticker).get().to_dict()
         stockDataList.append(docData)
-            
-    # Sorting the Stock Data List Based of Predeicted Values
-    keyVal = ""
-    if months < 12 : 
-        keyVal = f"{months}months"
-    elif months > 12 : 
-        keyVal = f"{months//12}years"
-    else : 
-        keyVal = "1year"
         
     stockDataList.sort(key = lambda x : x["predictions"][keyVal]["percentIncrease"], reverse = True)
     
@@ -512,15 +606,45 @@ def getStockPortfolioData (ticker : str, collectionName : str) -> dict :
             "error" : "Stock Data not found!"
         }
 
-def recommendStocks (investmentAmt : int, months : int, nStocks : int ,collectionName : str) : 
-    # Get all the stocks with currValue < investableAmount/5 
-    # Basically Abiliy to purchase more quantities of the stock
-    investableStockList = []
+def recommendStocks (investmentAmt : int, months : int, nStocks : int ,collectionName : str, maxWeight : float = 0.2) : 
+    # Creating the key string
+    keyStr = ""
+    if (months > 12) :     
+        keyStr = f"{months//12}years"
+    elif (months < 12) : 
+        keyStr = f"{months}months"
+    else : 
+        keyStr = "1year"
     
-    # Fetching all Data in FireStore
     db = firestore.client()
     stockDataCollection = db.collection(collectionName)
     
+    # Allocating from the precomputed return model when available
+    # so only the picked documents are read from Firestore
+    snapshot = getMarketSnapshot(MARKET_SNAPSHOT_FILE_PATH)
+    returnModel = getReturnModel(RETURN_MODEL_FILE_PATH)
+    if snapshot is not None and returnModel is not None : 
+        # Only recommending tickers still in the current list
+        tickersList = stockDataCollection.document("tickersList").get().to_dict()["tickers"]
+        allocation = allocatePortfolio(snapshot, returnModel, investmentAmt, keyStr, months, nStocks, maxWeight, allowedTickers=set(tickersList))
+        
+        recommendedStockList = []
+        for pick in allocation : 
+            stockData = stockDataCollection.document(pick["ticker"]).get().to_dict()
+            if stockData is None : 
+                continue
+            stockData["currPrice"] = pick["currPrice"]
+            stockData["percentGrowth"] = calculateSnapshotGrowth(snapshot, pick["ticker"], datetime.now() - relativedelta(months=months), datetime.now())
+            stockData["quantity"] = pick["quantity"]
+            stockData["allocatedAmt"] = pick["amount"]
+            recommendedStockList.append(stockData)
+            
+        return recommendedStockList
+    
+    # Get all the stocks with currValue < investableAmount/5 
+    # Basically Abiliy to purchase more quantities of the stock
+    investableStockList = []
+    
     tickerList = stockDataCollection.document("tickersList").get().to_dict()["tickers"]
     
     for ticker in tickerList :
@@ -537,16 +661,6 @@ def recommendStocks (investmentAmt : int, months : int, nStocks : int ,collectio
             investableStockList.append(stockData)
     
     # Sort the stocks based on the predicted Future Growth in n months
-    # Creating the key string
-    keyStr = ""
-    if (months > 12) :     
-        keyStr = f"{months//12}years"
-    elif (months < 12) : 
-        keyStr = f"{months}months"
-    else : 
-        keyStr = "1year"
-        
-    # Sorting the data
     investableStockList.sort(key = lambda obj : obj["predictions"][keyStr]["percentIncrease"])
     investableStockList.reverse()
     